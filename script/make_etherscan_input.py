@@ -8,7 +8,35 @@
 # To generate for all facets + diamond dispatcher:
 #   python3 script/make_etherscan_input.py --all ./etherscan
 
-import json, subprocess, sys, os, re
+import hashlib, json, subprocess, sys, os, re, threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import Optional
+
+try:
+    import orjson  # optional: much faster (de)serialization of the large standard-input files
+except ImportError:
+    orjson = None
+
+# Concurrent `forge inspect` runs in one project race on writing out/ and cache/.
+_forge_lock = threading.Lock()
+
+# `forge inspect` results are cached here (relative to the repo root) between runs.
+_CACHE_DIR = os.path.join(".cache", "etherscan-input")
+
+# Output directories already created during this run.
+_ensured_dirs: set[str] = set()
+
+# Resolved source paths used by more than one --all target, and their encoded contents.
+# Only these are kept in memory; sources used by a single target are streamed and dropped.
+_shared_sources: set[str] = set()
+_source_cache: dict[str, bytes] = {}
+
+# Block and line comments, stripped in a single pass before looking for declarations.
+_COMMENTS = re.compile(r"/\*.*?\*/|//[^\n]*", re.DOTALL)
+_CONTRACT_DECL = re.compile(r"^\s*contract\s+([A-Za-z_]\w*)\b", re.MULTILINE)
 
 def _usage() -> str:
     return (
@@ -21,15 +49,89 @@ def _usage() -> str:
     )
 
 
+def _loads(raw):
+    return orjson.loads(raw) if orjson is not None else json.loads(raw)
+
+
+def _dumps(obj) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+    return json.dumps(obj, indent=2).encode("utf-8")
+
+
+@lru_cache(maxsize=None)
 def _run_forge_inspect(fq: str, field: str) -> str:
-    return subprocess.check_output(["forge", "inspect", fq, field]).decode().strip()
+    with _forge_lock:
+        return subprocess.check_output(["forge", "inspect", fq, field]).decode().strip()
+
+
+def _cache_path(fq: str) -> str:
+    # Readable prefix plus a digest of the exact fq, since the flattened names alone can
+    # collide (src/a_b.sol:X vs src/a/b.sol:X).
+    name = fq.replace("/", "_").replace(os.sep, "_").replace(":", "__")
+    digest = hashlib.sha256(fq.encode("utf-8")).hexdigest()[:16]
+    return os.path.join(_CACHE_DIR, f"{name}-{digest}.json")
+
+
+def _file_stamp(path: str) -> Optional[list[int]]:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_mtime_ns, st.st_size]
+
+
+def _source_stamps(fq: str, meta: dict) -> dict:
+    # Metadata depends on the contract file, every source it pulls in and the Foundry config.
+    paths = {fq.rpartition(":")[0], "foundry.toml", *meta.get("sources", {}).keys()}
+    return {p: _file_stamp(p) for p in sorted(paths)}
+
+
+@lru_cache(maxsize=None)
+def _toolchain_key() -> dict:
+    # Metadata also depends on the active profile/config overrides and the forge build itself.
+    env = {k: v for k, v in sorted(os.environ.items()) if k.startswith("FOUNDRY_")}
+    try:
+        forge_version = subprocess.check_output(["forge", "--version"]).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        forge_version = None
+    return {"env": env, "forge": forge_version}
+
+
+def _inspect_metadata(fq: str) -> dict:
+    cache_path = _cache_path(fq)
+    try:
+        with open(cache_path, "rb") as f:
+            cached = _loads(f.read())
+    except (OSError, ValueError):
+        cached = None
+    if (
+        cached
+        and cached.get("contract") == fq
+        and cached.get("toolchain") == _toolchain_key()
+        and all(_file_stamp(p) == stamp for p, stamp in cached.get("stamps", {}).items())
+    ):
+        return _parse_metadata(cached["raw"])
+
+    raw = _run_forge_inspect(fq, "metadata")
+    meta = _parse_metadata(raw)
+    entry = {
+        "contract": fq,
+        "toolchain": _toolchain_key(),
+        "stamps": _source_stamps(fq, meta),
+        "raw": raw,
+    }
+    _write_json(cache_path, entry)
+    return meta
 
 
 def _parse_metadata(raw: str) -> dict:
     # Normalize to dict (some Foundry versions return a quoted JSON string)
-    if raw.startswith("{"):
-        return json.loads(raw)
-    return json.loads(json.loads(raw))
+    if raw.startswith('"'):
+        # Unescape the string literal with the C scanner instead of a full second parse.
+        inner, _ = json.decoder.scanstring(raw, 1)
+        return _loads(inner)
+    return _loads(raw)
 
 
 def _extract_solc_version(meta: dict) -> str:
@@ -46,7 +148,7 @@ def _extract_solc_version(meta: dict) -> str:
     return "<unknown>"
 
 
-def _build_standard_input(meta: dict) -> dict:
+def _build_settings(meta: dict) -> dict:
     # Standard-JSON "settings": keep only allowed keys, add sane defaults
     raw_settings = meta.get("settings", {})
     allow = {"optimizer", "evmVersion", "metadata", "libraries", "viaIR", "remappings", "outputSelection"}
@@ -54,90 +156,245 @@ def _build_standard_input(meta: dict) -> dict:
 
     # Ensure outputSelection so solc returns bytecode/abi predictably
     settings.setdefault("outputSelection", {"*": {"*": ["abi", "evm.bytecode", "evm.deployedBytecode"]}})
-
-    language = meta.get("language", "Solidity")
-
-    # Inline source contents for every file listed in metadata.sources
-    sources = {}
+    return settings
+
+
+def _read_text(fs_path: str) -> str:
+    # Read the whole file in one syscall and decode once, bypassing the TextIOWrapper stack.
+    fd = os.open(fs_path, os.O_RDONLY)
+    try:
+        size = os.fstat(fd).st_size
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(fd, 0, size, os.POSIX_FADV_SEQUENTIAL)
+        data = os.read(fd, size)
+        while len(data) < size:
+            # Short reads are unusual for regular files, but not ruled out.
+            chunk = os.read(fd, size - len(data))
+            if not chunk:
+                break
+            data += chunk
+    finally:
+        os.close(fd)
+    return data.decode("utf-8")
+
+
+@lru_cache(maxsize=None)
+def _resolve_source(path: str, repo_root: str) -> str:
+    fs_path = os.path.normpath(os.path.join(repo_root, path))
+    return fs_path if os.path.isfile(fs_path) else os.path.normpath(path)
+
+
+def _load_source(fs_path: str) -> bytes:
+    # JSON-encoded file content. Facets share most of their sources (libraries, interfaces,
+    # storage), so under --all those are read and escaped once; the rest is not retained.
+    encoded = _source_cache.get(fs_path)
+    if encoded is None:
+        encoded = _dumps(_read_text(fs_path))
+        if fs_path in _shared_sources:
+            _source_cache[fs_path] = encoded
+    return encoded
+
+
+def _iter_sources(meta: dict):
+    # Yield (path, fs_path) for every file listed in metadata.sources
     repo_root = os.getcwd()
     for path in meta.get("sources", {}).keys():
-        fs_path = os.path.normpath(os.path.join(repo_root, path))
-        if not os.path.isfile(fs_path):
-            fs_path = os.path.normpath(path)
-        with open(fs_path, "r", encoding="utf-8") as f:
-            sources[path] = {"content": f.read()}
+        yield path, _resolve_source(path, repo_root)
+
+
+def _ensure_parent_dir(path: str) -> None:
+    # Output and sidecar share a directory (and --all targets share one out_dir),
+    # so only the first write per directory needs to hit the filesystem.
+    d = os.path.dirname(path)
+    if d and d not in _ensured_dirs:
+        os.makedirs(d, exist_ok=True)
+        _ensured_dirs.add(d)
+
+
+@contextmanager
+def _atomic_open(path: str):
+    # Write to <path>.tmp and move it into place only once complete, so a failure midway
+    # (missing or non-UTF-8 source, ...) leaves the previous output untouched.
+    _ensure_parent_dir(path)
+    tmp_path = path + ".tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            yield f
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def _write_standard_input(path: str, meta: dict) -> None:
+    # Stream the Standard-JSON document instead of assembling it as one dict
+    # (the full input inlines every source and easily reaches tens of MB).
+    language = meta.get("language", "Solidity")
+    settings = _build_settings(meta)
 
-    return {"language": language, "settings": settings, "sources": sources}
+    with _atomic_open(path) as f:
+        f.write(b'{\n  "language": ' + _dumps(language))
+        f.write(b',\n  "settings": ' + _dumps(settings).replace(b"\n", b"\n  "))
+        f.write(b',\n  "sources": {')
+        sep = b"\n    "
+        for src_path, fs_path in _iter_sources(meta):
+            f.write(sep + _dumps(src_path) + b': {"content": ' + _load_source(fs_path) + b"}")
+            sep = b",\n    "
+        f.write(b"\n  }\n}")
 
 
 def _write_json(path: str, obj: dict) -> None:
-    os.makedirs(os.path.dirname(path), exist_ok=True)
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(obj, f, indent=2)
+    with _atomic_open(path) as f:
+        f.write(_dumps(obj))
 
 
-def _print_verification_hints(fq: str, meta: dict) -> None:
-    solc_version = _extract_solc_version(meta)
+def _verification_info(fq: str, meta: dict) -> dict:
+    # The handful of values Etherscan's manual verification form asks for; unset ones are omitted.
     settings = meta.get("settings", {}) or {}
     optimizer = settings.get("optimizer", {}) or {}
-    optimizer_enabled = optimizer.get("enabled")
-    optimizer_runs = optimizer.get("runs")
-    evm_version = settings.get("evmVersion")
-    via_ir = settings.get("viaIR")
-    bytecode_hash = (settings.get("metadata") or {}).get("bytecodeHash")
-
-    print("\n=== Etherscan verification hints ===")
-    print(f"Contract: {fq}")
-    print(f"solc: {solc_version}")
-    if evm_version is not None:
-        print(f"evmVersion: {evm_version}")
-    if via_ir is not None:
-        print(f"viaIR: {via_ir}")
-    if optimizer_enabled is not None:
-        print(f"optimizer.enabled: {optimizer_enabled}")
-    if optimizer_runs is not None:
-        print(f"optimizer.runs: {optimizer_runs}")
-    if bytecode_hash is not None:
-        print(f"metadata.bytecodeHash: {bytecode_hash}")
-    print("===================================\n")
+    info = {
+        "contract": fq,
+        "solc": _extract_solc_version(meta),
+        "evmVersion": settings.get("evmVersion"),
+        "viaIR": settings.get("viaIR"),
+        "optimizer.enabled": optimizer.get("enabled"),
+        "optimizer.runs": optimizer.get("runs"),
+        "metadata.bytecodeHash": (settings.get("metadata") or {}).get("bytecodeHash"),
+    }
+    return {k: v for k, v in info.items() if v is not None}
+
+
+def _print_verification_hints(info: dict, out_path: str) -> None:
+    # Emit the block (and the output path) as a single write so concurrent --all workers
+    # can't interleave their output.
+    lines = ["", "=== Etherscan verification hints ===", f"Contract: {info['contract']}"]
+    lines += [f"{key}: {value}" for key, value in info.items() if key != "contract"]
+    lines += ["===================================", "", out_path]
+    sys.stdout.write("\n".join(lines) + "\n")
 
 
 def _parse_contract_names_from_file(sol_path: str) -> list[str]:
     # Very small parser: grab `contract X` declarations.
     # (Facets are expected to be contracts; we intentionally skip interfaces/libraries.)
     with open(sol_path, "r", encoding="utf-8") as f:
-        src = f.read()
-    # Strip block comments to avoid accidental matches.
-    src = re.sub(r"/\*.*?\*/", "", src, flags=re.DOTALL)
-    names = []
-    for line in src.splitlines():
-        # remove line comments
-        line = line.split("//", 1)[0]
-        m = re.match(r"^\s*contract\s+([A-Za-z_]\w*)\b", line)
-        if m:
-            names.append(m.group(1))
-    return names
-
-
-def _generate_one(fq: str, out_path: str) -> None:
-    raw = _run_forge_inspect(fq, "metadata")
-    meta = _parse_metadata(raw)
-    std_input = _build_standard_input(meta)
+        src = _COMMENTS.sub("", f.read())
+    return [m.group(1) for m in _CONTRACT_DECL.finditer(src)]
+
+
+# Unlinked library runtime code opens with the call-protection `PUSH20 <library address>`.
+_LIBRARY_RUNTIME_PREFIX = "73" + "00" * 20
+
+
+def _is_concrete_contract(artifact: dict, name: str) -> bool:
+    ast = artifact.get("ast")
+    if ast:
+        for node in ast.get("nodes", []):
+            if node.get("nodeType") == "ContractDefinition" and node.get("name") == name:
+                return node.get("contractKind") == "contract" and not node.get("abstract")
+        return False
+    # No AST (artifact not built with --ast): interfaces and abstract contracts have no
+    # creation code, and libraries are recognizable by their runtime prefix.
+    bytecode = (artifact.get("bytecode") or {}).get("object") or ""
+    deployed = (artifact.get("deployedBytecode") or {}).get("object") or ""
+    if bytecode.removeprefix("0x") == "":
+        return False
+    return not deployed.removeprefix("0x").startswith(_LIBRARY_RUNTIME_PREFIX)
+
+
+def _artifact_contracts(artifacts_dir: str, rel_sol: str) -> Optional[dict[str, Optional[dict]]]:
+    # Foundry writes one artifact per contract under out/<File.sol>/; the compiler's own
+    # compilationTarget + AST/bytecode tell us which of them are concrete contracts from this file,
+    # and rawMetadata is exactly what `forge inspect <fq> metadata` would print.
+    # Maps contract name -> metadata (None if the artifact carries none), or returns None
+    # when the file has no artifacts so callers can fall back to the regex.
+    art_dir = os.path.join(artifacts_dir, os.path.basename(rel_sol))
+    if not os.path.isdir(art_dir):
+        return None
+    source_key = rel_sol.replace(os.sep, "/")
+    matched = False
+    contracts = {}
+    with os.scandir(art_dir) as it:
+        for e in sorted(it, key=lambda e: e.name):
+            if not e.name.endswith(".json"):
+                continue
+            with open(e.path, "rb") as f:
+                artifact = _loads(f.read())
+            meta = artifact.get("metadata") or {}
+            name = ((meta.get("settings") or {}).get("compilationTarget") or {}).get(source_key)
+            if name is None:
+                # Another file with the same basename also lands in this directory.
+                continue
+            matched = True
+            if name in contracts:
+                continue
+            if not _is_concrete_contract(artifact, name):
+                continue
+            raw = artifact.get("rawMetadata")
+            if isinstance(raw, str) and raw:
+                meta = _parse_metadata(raw)
+            contracts[name] = meta if "sources" in meta else None
+    return contracts if matched else None
+
+
+def _iter_sol(root: str):
+    # Recursively yield .sol files; DirEntry type info avoids an extra stat per entry.
+    with os.scandir(root) as it:
+        for e in it:
+            if e.is_dir(follow_symlinks=False):
+                yield from _iter_sol(e.path)
+            elif e.name.endswith(".sol") and e.is_file(follow_symlinks=False):
+                yield e.path
+
+
+def _input_digest(meta: dict, info: dict) -> str:
+    # Everything the two output files are derived from: settings, the sidecar values and
+    # each source's path + mtime/size stamp (cheaper than hashing the contents).
+    h = hashlib.sha256()
+    h.update(_dumps(meta.get("language", "Solidity")))
+    h.update(_dumps(_build_settings(meta)))
+    h.update(_dumps(info))
+    repo_root = os.getcwd()
+    for path in sorted(meta.get("sources", {})):
+        h.update(_dumps([path, _file_stamp(_resolve_source(path, repo_root))]))
+    return h.hexdigest()
 
-    _write_json(out_path, std_input)
-    _print_verification_hints(fq, meta)
 
-    # Also write a small sidecar with the exact compiler version/settings for easy copy-paste.
-    info_path = out_path.replace(".standard-input.json", ".verification-info.json")
-    solc_version = _extract_solc_version(meta)
-    info = {
-        "contract": fq,
-        "solc": solc_version,
-        "settings": meta.get("settings", {}),
-    }
-    _write_json(info_path, info)
+def _is_up_to_date(hash_path: str, digest: str, *outputs: str) -> bool:
+    try:
+        with open(hash_path, "r", encoding="utf-8") as f:
+            stored = f.read().strip()
+    except OSError:
+        return False
+    return stored == digest and all(os.path.isfile(p) for p in outputs)
+
 
-    print(out_path)
+def _build_one(fq: str, out_path: str, meta: Optional[dict] = None) -> dict:
+    # Write the standard input + sidecar for one contract and return its verification info.
+    if meta is None:
+        meta = _inspect_metadata(fq)
+
+    # Next to the standard input goes a small sidecar with the exact compiler version/settings
+    # for easy copy-paste.
+    base, _ = os.path.splitext(out_path)
+    info_path = base.removesuffix(".standard-input") + ".verification-info.json"
+    info = _verification_info(fq, meta)
+
+    # Skip rewriting both files when none of their inputs changed since the last run.
+    hash_path = out_path + ".hash"
+    digest = _input_digest(meta, info)
+    if not _is_up_to_date(hash_path, digest, out_path, info_path):
+        _write_standard_input(out_path, meta)
+        _write_json(info_path, info)
+        with _atomic_open(hash_path) as f:
+            f.write(digest.encode("ascii") + b"\n")
+    return info
+
+
+def _generate_one(fq: str, out_path: str, meta: Optional[dict] = None) -> None:
+    _print_verification_hints(_build_one(fq, out_path, meta), out_path)
 
 
 def _generate_all(out_dir: str) -> None:
@@ -145,36 +402,68 @@ def _generate_all(out_dir: str) -> None:
     facets_dir = os.path.join(repo_root, "src", "facets")
     diamond_file = os.path.join(repo_root, "src", "IdeationMarketDiamond.sol")
 
-    targets: list[tuple[str, str]] = []
-
-    # Diamond dispatcher
-    if os.path.isfile(diamond_file):
-        for name in _parse_contract_names_from_file(diamond_file):
-            rel = os.path.relpath(diamond_file, repo_root)
+    artifacts_dir = os.path.join(repo_root, "out")
+
+    # One build up front refreshes the src/ artifacts; per-contract metadata is then read from
+    # out/ instead of spawning `forge inspect` for each target; --ast lets the artifacts say
+    # which declarations are concrete contracts. Tests and scripts are skipped since compiling
+    # them (via-IR) is not needed here. Build logs go to stderr so stdout
+    # stays limited to the hints/output paths.
+    try:
+        subprocess.run(["forge", "build", "--ast", "--skip", "test", "--skip", "script"], check=True, stdout=sys.stderr)
+    except FileNotFoundError:
+        raise SystemExit("forge not found on PATH; install Foundry to generate inputs.")
+    except subprocess.CalledProcessError as e:
+        raise SystemExit(f"forge build failed (exit code {e.returncode}); see the compiler output above.")
+
+    # Diamond dispatcher + facets
+    sol_files = [diamond_file] if os.path.isfile(diamond_file) else []
+    if os.path.isdir(facets_dir):
+        sol_files.extend(_iter_sol(facets_dir))
+
+    targets: list[tuple[str, str, Optional[dict]]] = []
+    for sol_path in sol_files:
+        rel = os.path.relpath(sol_path, repo_root)
+        contracts = _artifact_contracts(artifacts_dir, rel)
+        if contracts is None:
+            contracts = dict.fromkeys(_parse_contract_names_from_file(sol_path))
+        for name, meta in contracts.items():
             fq = f"{rel}:{name}"
             out_path = os.path.join(out_dir, f"{name}.standard-input.json")
-            targets.append((fq, out_path))
-
-    # Facets
-    if os.path.isdir(facets_dir):
-        for root, _, files in os.walk(facets_dir):
-            for fn in files:
-                if not fn.endswith(".sol"):
-                    continue
-                sol_path = os.path.join(root, fn)
-                rel = os.path.relpath(sol_path, repo_root)
-                for name in _parse_contract_names_from_file(sol_path):
-                    fq = f"{rel}:{name}"
-                    out_path = os.path.join(out_dir, f"{name}.standard-input.json")
-                    targets.append((fq, out_path))
+            targets.append((fq, out_path, meta))
 
     if not targets:
         raise SystemExit("No contracts found to generate inputs for.")
 
-    # Generate deterministically (stable order)
+    # Contracts with the same name in different files would race on one output file.
+    by_out_path: dict[str, list[str]] = {}
+    for fq, out_path, _ in targets:
+        by_out_path.setdefault(out_path, []).append(fq)
+    clashes = {p: fqs for p, fqs in by_out_path.items() if len(fqs) > 1}
+    if clashes:
+        lines = [f"  {p}: {', '.join(sorted(fqs))}" for p, fqs in sorted(clashes.items())]
+        raise SystemExit("Multiple contracts map to the same output file:\n" + "\n".join(lines))
+
+    # Build concurrently, report deterministically: ex.map yields in submission (sorted)
+    # order, so hints are printed in that order as soon as each target is done. Targets
+    # without artifacts wait on `forge inspect`, so threads are enough.
     targets.sort(key=lambda t: t[0])
-    for fq, out_path in targets:
-        _generate_one(fq, out_path)
+
+    # Keep only sources referenced by several targets (as far as their metadata is already
+    # known from artifacts) in memory for the duration of the run.
+    uses = Counter(
+        _resolve_source(path, repo_root) for _, _, meta in targets if meta for path in meta.get("sources", {})
+    )
+    _shared_sources.update(p for p, n in uses.items() if n > 1)
+
+    max_workers = min(len(targets), (os.cpu_count() or 1) * 2)
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as ex:
+            for (_, out_path, _), info in zip(targets, ex.map(lambda t: _build_one(*t), targets)):
+                _print_verification_hints(info, out_path)
+    finally:
+        _source_cache.clear()
+        _shared_sources.clear()
 
 
 def main() -> None: